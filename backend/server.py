@@ -1,13 +1,17 @@
 from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Depends, status, WebSocket
 from fastapi.security import HTTPBearer
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 import os
+import re
 import logging
 from pathlib import Path
+from dataclasses import dataclass
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Awaitable, Callable, List, Optional
 import uuid
+import secrets
 from datetime import datetime
 import shutil
 import aiofiles  # For async file ops
@@ -15,15 +19,17 @@ import asyncio
 import subprocess
 import psutil  # For process monitoring
 from enum import Enum
-from jose import JWTError, jwt
+from jose import JWTError, jwk, jwt
+from cachetools import TTLCache
 from passlib.context import CryptContext
 import socketio
 from motor.motor_asyncio import AsyncIOMotorClient
-from transformers import pipeline
-from functools import lru_cache
-import signal
-import json
+from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+import torch
+import orjson
 import threading
+import time
+import ctypes
 from concurrent.futures import ThreadPoolExecutor
 
 ROOT_DIR = Path(__file__).parent
@@ -47,15 +53,31 @@ SECRET_KEY = os.environ.get("SECRET_KEY", "your-secret-key-change-me")
 ALGORITHM = "HS256"
 security = HTTPBearer()
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+SIGNING_KEY = jwk.construct(SECRET_KEY, ALGORITHM)  # Key material prepared once, not per decode
+
+# Decoded tokens (token -> (did, exp)); sync dependency runs in the threadpool, hence the lock
+token_cache = TTLCache(maxsize=4096, ttl=60)
+token_cache_lock = threading.Lock()
 
 def verify_token(credentials: HTTPBearer = Depends(security)):
+    token = credentials.credentials
+    with token_cache_lock:
+        cached = token_cache.get(token)
+    if cached is not None:
+        did, exp = cached
+        if exp is None or exp > time.time():
+            return did
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SIGNING_KEY, algorithms=[ALGORITHM])
         did = payload.get("did")
         if did is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid DID")
+        with token_cache_lock:
+            token_cache[token] = (did, payload.get("exp"))
         return did
     except JWTError:
+        with token_cache_lock:
+            token_cache.pop(token, None)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
 
 # CORS (restricted, integrated with JS origins)
@@ -68,16 +90,118 @@ app.add_middleware(
 )
 
 # SocketIO for WebRTC (with RustDesk fallback, integrated JS Socket.IO logic)
-sio = socketio.AsyncServer(cors_allowed_origins='*', async_mode='asgi')
+class OrjsonCodec:
+    # Module-like json hook for python-socketio/engineio; they pass stdlib kwargs and expect str
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        return orjson.loads(s)
+
+sio = socketio.AsyncServer(cors_allowed_origins='*', async_mode='asgi', json=OrjsonCodec)
 app.mount("/api/webrtc", socketio.ASGIApp(sio))
 
+# Broadcasts to large audiences are chunked so the loop can service other sockets/HTTP in between
+BROADCAST_BATCH_SIZE = 50
+
+async def broadcast_batched(event: str, data, room: str = None, skip_sid: str = None, batch_size: int = BROADCAST_BATCH_SIZE):
+    sids = [s for s, _ in sio.manager.get_participants('/', room) if s != skip_sid]
+    if len(sids) < batch_size:
+        # Small audience: single emit keeps latency low
+        await sio.emit(event, data, room=room, skip_sid=skip_sid)
+        return
+    for i in range(0, len(sids), batch_size):
+        # One encode per batch; the manager sends to the batch's sids concurrently
+        await sio.emit(event, data, to=sids[i:i + batch_size])
+        await asyncio.sleep(0)  # Yield to the loop between batches (JS setImmediate equivalent)
+
 # Upload directory for APKs
 UPLOAD_DIR = ROOT_DIR / 'uploads'
 UPLOAD_DIR.mkdir(exist_ok=True)
+UPLOAD_CHUNK_SIZE = 1 << 16  # 64 KiB; uploads are streamed, never held whole in memory
 
 # Device limits (integrated JS resource monitor concept)
 MOCK_DEVICE_RAM = 4096  # MB
 
+# Periodic monitors (JS setInterval 30000ms): timerfd wakeups, /proc sampling off the loop thread
+MONITOR_INTERVAL = 30  # seconds
+# Single worker: samples and fd closes run in submission order, so a cached fd is never read after close
+monitor_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="monitor")
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+class _Itimerspec(ctypes.Structure):
+    _fields_ = [("it_interval", _Timespec), ("it_value", _Timespec)]
+
+def open_timerfd(interval: float) -> Optional[int]:
+    # Non-blocking CLOCK_MONOTONIC timerfd firing every `interval`s; None where unsupported
+    if hasattr(os, 'timerfd_create'):  # Python 3.13+
+        fd = os.timerfd_create(time.CLOCK_MONOTONIC, flags=os.TFD_NONBLOCK | os.TFD_CLOEXEC)
+        os.timerfd_settime(fd, initial=interval, interval=interval)
+        return fd
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        timerfd_create, timerfd_settime = libc.timerfd_create, libc.timerfd_settime
+    except (OSError, AttributeError):  # Non-Linux libc
+        return None
+    fd = timerfd_create(time.CLOCK_MONOTONIC, os.O_NONBLOCK | os.O_CLOEXEC)  # TFD_* share O_* values
+    if fd < 0:
+        return None
+    sec, frac = divmod(interval, 1)
+    period = _Timespec(int(sec), int(frac * 1e9))
+    if timerfd_settime(fd, 0, ctypes.byref(_Itimerspec(period, period)), None) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+async def periodic_ticks(interval: float = MONITOR_INTERVAL):
+    # Yields once per expiration; missed expirations coalesce into a single tick
+    loop = asyncio.get_running_loop()
+    fd = open_timerfd(interval)
+    if fd is None:
+        # Fallback: sleep to absolute deadlines so lateness doesn't accumulate
+        deadline = loop.time()
+        while True:
+            deadline += interval
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+            yield
+    else:
+        due = asyncio.Event()
+
+        def on_expire():
+            try:
+                os.read(fd, 8)  # uint64 expiration count
+            except BlockingIOError:
+                return
+            due.set()
+
+        loop.add_reader(fd, on_expire)
+        try:
+            while True:
+                await due.wait()
+                due.clear()
+                yield
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+
+async def run_sampler(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(monitor_executor, func, *args)
+
+# One scheduler task serves every monitor; samplers do a single short pass per tick
+monitors: dict[str, Callable[[], Awaitable[None]]] = {}  # {key: sampler}
+
+async def scheduler():
+    async for _ in periodic_ticks():
+        for key, sampler in list(monitors.items()):
+            try:
+                await sampler()
+            except Exception as e:
+                logger.error(f"Monitor {key} failed: {e}")
+
 # RustDesk Config (from JS integration)
 RUSTDESK_PATH = Path(os.environ.get('RUSTDESK_PATH', ROOT_DIR / 'rustdesk-server/target/release'))
 RUSTDESK_KEY = os.environ.get('RUSTDESK_KEY', '_')
@@ -85,7 +209,49 @@ HBBS_PORTS = os.environ.get('RUSTDESK_PORTS', '21115-21117')
 HBRR_PORTS = os.environ.get('RELAY_PORTS', '21116-21119')
 
 # RustDesk Process Management (from JS)
-rustdesk_processes = {}  # {sid: {'hbbs': proc, 'hbbrs': proc}}
+@dataclass(slots=True)
+class RustDeskProcs:
+    hbbs: asyncio.subprocess.Process
+    hbbrs: asyncio.subprocess.Process
+    hbbs_ps: Optional[psutil.Process]  # Primed psutil handles (see primed_process)
+    hbbrs_ps: Optional[psutil.Process]
+    hbbs_statm: Optional[int]  # Persistent /proc/<pid>/statm fds (see open_statm)
+    hbbrs_statm: Optional[int]
+
+rustdesk_processes: dict[str, RustDeskProcs] = {}  # {sid: RustDeskProcs}
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def primed_process(pid: int) -> Optional[psutil.Process]:
+    # Cached handle; first cpu_percent(None) sets the baseline so later calls never sleep
+    try:
+        p = psutil.Process(pid)
+        p.cpu_percent(None)
+        return p
+    except psutil.NoSuchProcess:
+        return None
+
+def open_statm(pid: int) -> Optional[int]:
+    # Kept open across cycles; None where /proc isn't available (psutil fallback)
+    try:
+        return os.open(f"/proc/{pid}/statm", os.O_RDONLY | os.O_CLOEXEC)
+    except OSError:
+        return None
+
+def close_statm(fd: Optional[int]):
+    if fd is not None:
+        monitor_executor.submit(os.close, fd)
+
+def sample_process(p: psutil.Process, statm_fd: Optional[int] = None):
+    if statm_fd is None:
+        with p.oneshot():
+            return p.cpu_percent(None), p.memory_info().rss  # % since last sample, no blocking interval
+    try:
+        fields = os.pread(statm_fd, 64, 0).split()  # "size resident shared ..." in pages
+    except OSError:
+        raise psutil.NoSuchProcess(p.pid)
+    if len(fields) < 2:
+        raise psutil.NoSuchProcess(p.pid)
+    return p.cpu_percent(None), int(fields[1]) * PAGE_SIZE
 
 async def start_rustdesk_server(session_id: str):
     if session_id in rustdesk_processes:
@@ -109,67 +275,101 @@ async def start_rustdesk_server(session_id: str):
             stderr=asyncio.subprocess.DEVNULL
         )
         
-        rustdesk_processes[session_id] = {'hbbs': hbbs_proc, 'hbbrs': hbbrs_proc}
+        rustdesk_processes[session_id] = RustDeskProcs(
+            hbbs=hbbs_proc,
+            hbbrs=hbbrs_proc,
+            hbbs_ps=primed_process(hbbs_proc.pid),
+            hbbrs_ps=primed_process(hbbrs_proc.pid),
+            hbbs_statm=open_statm(hbbs_proc.pid),
+            hbbrs_statm=open_statm(hbbrs_proc.pid),
+        )
         
         # Background monitor for CPU/RAM (integrated JS interval logic)
-        asyncio.create_task(monitor_rustdesk(session_id))
+        monitors[f"rustdesk:{session_id}"] = lambda: sample_rustdesk(session_id)
         
         logger.info(f"RustDesk started for session {session_id}")
         return {"status": "started", "hbbs_pid": hbbs_proc.pid, "hbbrs_pid": hbbrs_proc.pid}
     except FileNotFoundError:
         raise HTTPException(status_code=500, detail="RustDesk binaries not found; build from source")
 
-async def monitor_rustdesk(session_id: str):
-    while session_id in rustdesk_processes:
-        procs = rustdesk_processes[session_id]
-        for name, proc in procs.items():
-            if proc.returncode is not None:
-                del rustdesk_processes[session_id]
-                logger.warning(f"RustDesk {name} died for {session_id}")
-                break
-            try:
-                p = psutil.Process(proc.pid)
-                if p.cpu_percent(interval=1) > 70 or (p.memory_info().rss / 1024 / 1024) > 500:  # MB cap
-                    logger.warning(f"RustDesk {name} over limit; pausing")
-                    # Emit to clients via SocketIO (JS io.emit equivalent)
-                    await sio.emit('rustdesk_pause', {'reason': 'resource_limit'}, room=session_id)
-                    # Optional: proc.terminate()
-            except psutil.NoSuchProcess:
-                pass
-        await asyncio.sleep(30)  # JS 30000ms equivalent
+def release_rustdesk(session_id: str):
+    procs = rustdesk_processes.pop(session_id, None)
+    monitors.pop(f"rustdesk:{session_id}", None)
+    if procs is not None:
+        close_statm(procs.hbbs_statm)
+        close_statm(procs.hbbrs_statm)
+
+async def check_rustdesk_usage(session_id: str, name: str, p: Optional[psutil.Process], statm_fd: Optional[int]):
+    if p is None:
+        return
+    try:
+        cpu, rss = await run_sampler(sample_process, p, statm_fd)
+        if cpu > 70 or (rss / 1024 / 1024) > 500:  # MB cap
+            logger.warning(f"RustDesk {name} over limit; pausing")
+            # Emit to clients via SocketIO (JS io.emit equivalent)
+            await broadcast_batched('rustdesk_pause', {'reason': 'resource_limit'}, room=session_id)
+            # Optional: proc.terminate()
+    except psutil.NoSuchProcess:
+        pass
+
+async def sample_rustdesk(session_id: str):
+    procs = rustdesk_processes.get(session_id)
+    if procs is None:
+        monitors.pop(f"rustdesk:{session_id}", None)
+        return
+    if procs.hbbs.returncode is not None or procs.hbbrs.returncode is not None:
+        name = 'hbbs' if procs.hbbs.returncode is not None else 'hbbrs'
+        release_rustdesk(session_id)
+        logger.warning(f"RustDesk {name} died for {session_id}")
+        return
+    await check_rustdesk_usage(session_id, 'hbbs', procs.hbbs_ps, procs.hbbs_statm)
+    if rustdesk_processes.get(session_id) is procs:  # Not released (fds closed) while hbbs was sampled
+        await check_rustdesk_usage(session_id, 'hbbrs', procs.hbbrs_ps, procs.hbbrs_statm)
 
 async def stop_rustdesk_server(session_id: str):
     if session_id not in rustdesk_processes:
         return {"status": "not_running"}
     
-    for name, proc in rustdesk_processes[session_id].items():
+    procs = rustdesk_processes[session_id]
+    for proc in (procs.hbbs, procs.hbbrs):
         if proc.returncode is None:
             proc.terminate()
             try:
-                proc.wait(timeout=5)
+                await asyncio.wait_for(proc.wait(), timeout=5)  # asyncio Process.wait() takes no timeout
             except asyncio.TimeoutError:
                 proc.kill()
+                await proc.wait()
     
-    del rustdesk_processes[session_id]
+    release_rustdesk(session_id)
     logger.info(f"RustDesk stopped for {session_id}")
     return {"status": "stopped"}
 
 # Resource Monitor (integrated from JS setInterval)
-async def resource_monitor():
-    while True:
-        # Mock DeviceInfo.getTotalRamMb() with psutil
-        ram_info = psutil.virtual_memory()
-        total_ram_mb = ram_info.total / (1024 * 1024)
-        ram_pct = ram_info.percent / 100
-        if ram_pct > 0.8:  # JS 0.8 cap
-            await sio.emit('resource_warning', { 'ram': ram_pct })  # Pause sessions
-            logger.warning(f"Resource warning: RAM usage {ram_pct:.2f}")
-        await asyncio.sleep(30)  # 30000ms
-
-# Start resource monitor on app startup
+async def sample_resources():
+    # Mock DeviceInfo.getTotalRamMb() with psutil
+    ram_info = await run_sampler(psutil.virtual_memory)
+    total_ram_mb = ram_info.total / (1024 * 1024)
+    ram_pct = ram_info.percent / 100
+    if ram_pct > 0.8:  # JS 0.8 cap
+        await broadcast_batched('resource_warning', { 'ram': ram_pct })  # Pause sessions
+        logger.warning(f"Resource warning: RAM usage {ram_pct:.2f}")
+
+# Start resource monitor and the shared scheduler on app startup
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(resource_monitor())
+    monitors["resources"] = sample_resources
+    asyncio.create_task(scheduler())
+    start_nlp_batcher()
+    asyncio.create_task(ensure_indexes())  # Background: an unreachable Mongo must not hold startup
+
+async def ensure_indexes():
+    # Index both branches of the RAM-budget $match; (status, ramRequired) also serves the running sum
+    try:
+        for collection in (db.os_environments, db.emulators):
+            await collection.create_index([("status", 1), ("ramRequired", 1)])
+            await collection.create_index("id")
+    except Exception as e:
+        logger.warning(f"Index creation failed: {e}")
 
 # Enums
 class OSStatus(str, Enum):
@@ -182,6 +382,7 @@ class EmulatorStatus(str, Enum):
     DOWNLOADING = "downloading"
     INSTALLED = "installed"
     RUNNING = "running"
+    STOPPED = "stopped"
     ERROR = "error"
 
 # Models (all from previous + JS integrations)
@@ -283,24 +484,112 @@ class RustDeskGenerate(BaseModel):
     device_id: str
 
 # AI Lazy Loading (integrated from previous)
-nlp_instance = None
-nlp_lock = asyncio.Lock()
+NLP_MODEL = "microsoft/Phi-3-mini-4k-instruct"
+_nlp_future: Optional[asyncio.Future] = None  # Shared load task; resolved once, awaited by every caller
+
+def build_nlp_pipeline():
+    # CPU host: INT8 dynamic quantization of the Linear layers (FBGEMM kernels use VNNI where present)
+    tokenizer = AutoTokenizer.from_pretrained(NLP_MODEL, padding_side="left")  # Decoder-only: pad left for batches
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(NLP_MODEL, dtype=torch.float32, low_cpu_mem_usage=True)
+    # inplace=True: no deep copy is made, so the peak is the single FP32 load; each Linear's FP32 weights
+    # are released as it is replaced by its INT8 counterpart
+    torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    model.eval()
+    return pipeline("text-generation", model=model, tokenizer=tokenizer, device=-1)
+
+async def _load_nlp():
+    try:
+        loop = asyncio.get_running_loop()
+        nlp = await loop.run_in_executor(None, build_nlp_pipeline)
+        logger.info("Phi-3 (INT8) loaded lazily")
+        return nlp
+    except Exception as e:
+        logger.error(f"Lazy AI load failed: {e}")
+        return None
 
-@lru_cache(maxsize=1)
 async def get_nlp_pipeline():
-    global nlp_instance
-    async with nlp_lock:
-        if nlp_instance is None:
-            try:
-                loop = asyncio.get_event_loop()
-                nlp_instance = await loop.run_in_executor(
-                    None, lambda: pipeline("text-generation", model="microsoft/Phi-3-mini-4k-instruct", device=-1)
-                )
-                logger.info("Phi-3 loaded lazily")
-            except Exception as e:
-                logger.error(f"Lazy AI load failed: {e}")
-                nlp_instance = None
-        return nlp_instance
+    global _nlp_future
+    if _nlp_future is None:
+        _nlp_future = asyncio.get_running_loop().create_task(_load_nlp())
+    future = _nlp_future
+    try:
+        nlp = await asyncio.shield(future)  # A cancelled caller must not cancel the shared load
+    except asyncio.CancelledError:
+        if future.cancelled() and _nlp_future is future:
+            _nlp_future = None  # Load itself was cancelled (e.g. shutdown): next caller starts over
+        raise
+    if nlp is None and _nlp_future is future:
+        _nlp_future = None  # Failed load: let the next caller retry
+    return nlp
+
+# Micro-batching: concurrent prompts share one forward pass
+NLP_BATCH_SIZE = 8
+NLP_BATCH_WAIT = 0.01  # seconds to wait for more prompts once one arrives
+NLP_MAX_NEW_TOKENS = 100  # Per-prompt output budget, independent of batch padding
+nlp_queue: asyncio.Queue = asyncio.Queue()  # (text, future) pairs
+nlp_batcher_task: Optional[asyncio.Task] = None
+
+def fail_futures(pairs, exc: Exception):
+    for _, future in pairs:
+        if not future.done():
+            future.set_exception(exc)
+
+async def run_nlp_batch(loop, batch):
+    batch = [(text, future) for text, future in batch if not future.done()]  # Drop cancelled callers
+    if not batch:
+        return
+    texts = [text for text, _ in batch]
+    nlp = await get_nlp_pipeline()
+    if nlp is None:
+        raise RuntimeError("AI pipeline unavailable")
+    outputs = await loop.run_in_executor(
+        None, lambda: nlp(texts, max_new_tokens=NLP_MAX_NEW_TOKENS, num_return_sequences=1, batch_size=len(texts))
+    )
+    for (_, future), output in zip(batch, outputs):
+        if not future.done():
+            future.set_result(output[0]['generated_text'])
+
+async def nlp_batcher():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await nlp_queue.get()]
+        try:
+            deadline = loop.time() + NLP_BATCH_WAIT
+            while len(batch) < NLP_BATCH_SIZE:
+                try:
+                    batch.append(await asyncio.wait_for(nlp_queue.get(), max(0.0, deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    break
+            await run_nlp_batch(loop, batch)
+        except Exception as e:
+            logger.error(f"AI batch failed: {e}")
+            fail_futures(batch, e)
+        except BaseException:
+            fail_futures(batch, RuntimeError("AI batcher stopped"))  # In-flight callers must not hang
+            raise
+
+def on_nlp_batcher_exit(task: asyncio.Task):
+    reason = "cancelled" if task.cancelled() else repr(task.exception())
+    logger.warning(f"AI batcher exited: {reason}")
+    pending = []
+    while not nlp_queue.empty():
+        pending.append(nlp_queue.get_nowait())
+    fail_futures(pending, RuntimeError("AI batcher stopped"))
+
+def start_nlp_batcher():
+    # (Re)start the single consumer; a dead batcher is replaced on the next request
+    global nlp_batcher_task
+    if nlp_batcher_task is None or nlp_batcher_task.done():
+        nlp_batcher_task = asyncio.get_running_loop().create_task(nlp_batcher())
+        nlp_batcher_task.add_done_callback(on_nlp_batcher_exit)
+
+async def generate_text(text: str) -> str:
+    start_nlp_batcher()
+    future = asyncio.get_running_loop().create_future()
+    await nlp_queue.put((text, future))
+    return await future
 
 # SocketIO Events (integrated JS io.on logic)
 @sio.event
@@ -334,11 +623,19 @@ async def join_room(sid, data):
     else:
         logger.warning(f"Invalid room join attempt by {sid}")
 
+async def relay_to_peers(event: str, data, room: str, sender: str):
+    # 1:1 WebRTC rooms hold two sids: send straight to the peer(s) instead of a skip_sid emit
+    peers = [peer for peer, _ in sio.manager.get_participants('/', room) if peer != sender]
+    if len(peers) == 1:
+        await sio.emit(event, data, to=peers[0])
+    elif peers:
+        await sio.emit(event, data, to=peers)  # One encode, concurrent sends
+
 @sio.event
 async def offer(sid, data):
     room = data.get('room')
     if room:
-        await sio.emit('offer', data, room=room, skip_sid=sid)
+        await relay_to_peers('offer', data, room, sid)
         logger.info(f"Offer sent to room {room} from {sid}")
     else:
         logger.warning(f"Invalid offer from {sid}")
@@ -347,7 +644,7 @@ async def offer(sid, data):
 async def answer(sid, data):
     room = data.get('room')
     if room:
-        await sio.emit('answer', data, room=room, skip_sid=sid)
+        await relay_to_peers('answer', data, room, sid)
         logger.info(f"Answer sent to room {room} from {sid}")
     else:
         logger.warning(f"Invalid answer from {sid}")
@@ -356,7 +653,7 @@ async def answer(sid, data):
 async def ice_candidate(sid, data):
     room = data.get('room')
     if room:
-        await sio.emit('ice-candidate', data, room=room, skip_sid=sid)
+        await relay_to_peers('ice-candidate', data, room, sid)
         logger.info(f"ICE candidate sent to room {room} from {sid}")
     else:
         logger.warning(f"Invalid ICE candidate from {sid}")
@@ -367,15 +664,55 @@ async def ice_failed(sid, data):  # Custom from JS
     if room:
         # Fallback to RustDesk (integrated JS logic)
         session_info = await generate_rustdesk_fallback(room)
-        await sio.emit('use_rustdesk', session_info, room=room, skip_sid=sid)
+        await broadcast_batched('use_rustdesk', session_info, room=room, skip_sid=sid)
         logger.info(f"RustDesk fallback triggered for room {room}")
 
+def new_rustdesk_id() -> str:
+    return secrets.token_hex(4).upper()  # 8-char ID, one getrandom call
+
 async def generate_rustdesk_fallback(room: str):
     # From JS Math.random logic
-    rustdesk_id = ''.join([str(uuid.uuid4().int >> 4 & 0xFFFF)[0:2] for _ in range(4)]).upper()  # 8-char mock
+    rustdesk_id = new_rustdesk_id()
     password = "123456"
     return {"rustdesk_id": rustdesk_id, "password": password, "room": room}
 
+# Streamed list responses
+LIST_BATCH_SIZE = 200  # Mongo cursor batch for streamed list endpoints
+STREAM_FLUSH_SIZE = 1 << 16  # Bytes buffered per response chunk
+
+def projection(model) -> dict:
+    return {"_id": 0, **{name: 1 for name in model.model_fields}}
+
+async def stream_json_array(cursor, fallback: Optional[list] = None) -> StreamingResponse:
+    # Same JSON array clients already parse, encoded batch by batch; never materialized in full.
+    # The first batch is read before the 200 goes out, so an unreachable Mongo still surfaces as a 5xx.
+    # Returning a Response bypasses response_model: docs go out as stored (projected), unvalidated, no defaults.
+    first = await cursor.to_list(LIST_BATCH_SIZE)
+    if not first and fallback:
+        first = fallback
+
+    async def body():
+        chunk = bytearray(b'[')
+        empty = True
+        docs = first
+        try:
+            while docs:
+                for doc in docs:
+                    if not empty:
+                        chunk += b','
+                    chunk += orjson.dumps(doc)
+                    empty = False
+                if len(chunk) >= STREAM_FLUSH_SIZE:
+                    yield bytes(chunk)
+                    chunk.clear()
+                docs = await cursor.to_list(LIST_BATCH_SIZE)
+        except Exception as e:
+            logger.error(f"List stream aborted mid-response: {e}")  # Headers already sent; body is truncated
+            raise
+        chunk += b']'
+        yield bytes(chunk)
+    return StreamingResponse(body(), media_type="application/json")
+
 # Routes (integrated all previous + JS endpoints)
 @api_router.get("/")
 async def root():
@@ -395,15 +732,15 @@ async def create_status_check(did: str = Depends(verify_token), input: StatusChe
 
 @api_router.get("/status", response_model=List[StatusCheck])
 async def get_status_checks(did: str = Depends(verify_token)):
-    status_checks = await db.status_checks.find().to_list(1000)
-    return [StatusCheck(**status_check) for status_check in status_checks]
+    cursor = db.status_checks.find({}, projection(StatusCheck)).batch_size(LIST_BATCH_SIZE)
+    return await stream_json_array(cursor)
 
 @api_router.get("/os_environments", response_model=List[OSEnvironment])
 async def get_os_environments(did: str = Depends(verify_token)):
-    os_envs = await db.os_environments.find().to_list(1000)
-    if not os_envs:  # JS mock fallback
-        os_envs = [{"id": "1", "name": "Android Lite", "icon": "terminal", "ramRequired": 1024, "status": "available"}]
-    return [OSEnvironment(**os_env) for os_env in os_envs]
+    cursor = db.os_environments.find({}, projection(OSEnvironment)).batch_size(LIST_BATCH_SIZE)
+    # JS mock fallback when the collection is empty
+    mock = [{"id": "1", "name": "Android Lite", "icon": "terminal", "ramRequired": 1024, "status": "available"}]
+    return await stream_json_array(cursor, fallback=mock)
 
 @api_router.post("/os_environments", response_model=OSEnvironment)
 async def create_os_environment(did: str = Depends(verify_token), input: OSEnvironmentCreate = None):
@@ -414,9 +751,26 @@ async def create_os_environment(did: str = Depends(verify_token), input: OSEnvir
     logger.info(f"Added OS environment: {input.name} for {did}")
     return os_env_obj
 
+async def find_with_running_ram(collection, doc_id: str, running_status: str):
+    # One round-trip: the target doc plus the RAM already held by running docs
+    result = await collection.aggregate([
+        {"$match": {"$or": [{"id": doc_id}, {"status": running_status}]}},
+        {"$facet": {
+            "target": [{"$match": {"id": doc_id}}, {"$limit": 1}],
+            "running_sum": [
+                {"$match": {"status": running_status}},
+                {"$group": {"_id": None, "s": {"$sum": "$ramRequired"}}},
+            ],
+        }},
+    ]).to_list(1)
+    facet = result[0]
+    target = facet["target"][0] if facet["target"] else None
+    running_ram = facet["running_sum"][0]["s"] if facet["running_sum"] else 0
+    return target, running_ram
+
 @api_router.post("/os_environments/{os_id}/toggle")
 async def toggle_os_environment(did: str = Depends(verify_token), os_id: str = None):
-    os_env = await db.os_environments.find_one({"id": os_id})
+    os_env, running_ram = await find_with_running_ram(db.os_environments, os_id, OSStatus.RUNNING.value)
     if not os_env:
         raise HTTPException(status_code=404, detail="OS environment not found")
     
@@ -424,18 +778,20 @@ async def toggle_os_environment(did: str = Depends(verify_token), os_id: str = N
     new_status = OSStatus.STOPPED if current_status == OSStatus.RUNNING else OSStatus.RUNNING
     
     if new_status == OSStatus.RUNNING and current_status != OSStatus.RUNNING:
-        running_os = await db.os_environments.find({"status": OSStatus.RUNNING}).to_list(1000)
-        running_ram = sum(o["ramRequired"] for o in running_os)
         if running_ram + os_env["ramRequired"] > MOCK_DEVICE_RAM:
             raise HTTPException(status_code=400, detail="Insufficient RAM to start this OS")
     
-    await db.os_environments.update_one({"id": os_id}, {"$set": {"status": new_status.value}})
+    # Conditional on the status we read, so a concurrent toggle fails instead of being overwritten
+    updated = await db.os_environments.find_one_and_update(
+        {"id": os_id, "status": current_status}, {"$set": {"status": new_status.value}}
+    )
+    if updated is None:
+        raise HTTPException(status_code=409, detail="OS environment changed concurrently; retry")
     logger.info(f"Toggled OS {os_id} to {new_status} for {did}")
     return {"message": f"OS toggled to {new_status}"}
 
 @api_router.post("/upload-apk")
 async def upload_apk(did: str = Depends(verify_token), file: UploadFile = File(...)):
-    UPLOAD_DIR.mkdir(exist_ok=True)
     apks_count = await db.apks.count_documents({})
     if apks_count >= 2:
         raise HTTPException(status_code=400, detail="Max 2 APKs")
@@ -444,8 +800,8 @@ async def upload_apk(did: str = Depends(verify_token), file: UploadFile = File(.
     
     file_path = UPLOAD_DIR / file.filename
     async with aiofiles.open(file_path, 'wb') as buffer:
-        content = await file.read()
-        await buffer.write(content)
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            await buffer.write(chunk)
     
     apk_obj = Apk(filename=file.filename)
     await db.apks.insert_one(apk_obj.dict())
@@ -455,12 +811,13 @@ async def upload_apk(did: str = Depends(verify_token), file: UploadFile = File(.
 @api_router.get("/apks", response_model=List[Apk])
 async def get_apks(did: str = Depends(verify_token)):
     apks = await db.apks.find().to_list(2)
-    return [Apk(**apk) for apk in apks]
+    # Written from Apk, so skip our own validation pass (response_model still validates once)
+    return [Apk.model_construct(**apk) for apk in apks]
 
 @api_router.get("/pwas", response_model=List[PWA])
 async def get_pwas(did: str = Depends(verify_token)):
-    pwas = await db.pwas.find().to_list(1000)
-    return [PWA(**p) for p in pwas]
+    cursor = db.pwas.find({}, projection(PWA)).batch_size(LIST_BATCH_SIZE)
+    return await stream_json_array(cursor)
 
 @api_router.post("/pwas", response_model=PWA)
 async def create_pwa(did: str = Depends(verify_token), input: PWACreate = None):
@@ -471,8 +828,8 @@ async def create_pwa(did: str = Depends(verify_token), input: PWACreate = None):
 
 @api_router.get("/suggestions", response_model=List[Suggestion])
 async def get_suggestions(did: str = Depends(verify_token)):
-    suggestions = await db.suggestions.find().to_list(1000)
-    return [Suggestion(**suggestion) for suggestion in suggestions]
+    cursor = db.suggestions.find({}, projection(Suggestion)).batch_size(LIST_BATCH_SIZE)
+    return await stream_json_array(cursor)
 
 @api_router.post("/suggestions/accept/{suggestion_id}")
 async def accept_suggestion(did: str = Depends(verify_token), suggestion_id: str = None):
@@ -492,31 +849,43 @@ async def create_message(did: str = Depends(verify_token), input: MessageCreate
 
 @api_router.get("/messages", response_model=List[Message])
 async def get_messages(did: str = Depends(verify_token)):
-    messages = await db.messages.find().to_list(1000)
-    return [Message(**message) for message in messages]
+    cursor = db.messages.find({}, projection(Message)).batch_size(LIST_BATCH_SIZE)
+    return await stream_json_array(cursor)
+
+# Keyword router (integrated JS keyword logic): one case-insensitive scan, substring matches as before
+TASK_KEYWORDS = re.compile(r'(?P<alarm>alarm|reminder)|(?P<iot>iot|light)|(?P<script>script|bash)', re.IGNORECASE)
+TASK_PRIORITY = ("alarm", "iot", "script")  # Earlier wins when several match, like the old if/elif chain
+
+def route_task(text: str) -> Optional[str]:
+    found = set()
+    for match in TASK_KEYWORDS.finditer(text):
+        if match.lastgroup == TASK_PRIORITY[0]:
+            return match.lastgroup
+        found.add(match.lastgroup)
+    return next((task for task in TASK_PRIORITY if task in found), None)
 
 @api_router.post("/automate", response_model=AutomateResponse)
 async def automate_task(did: str = Depends(verify_token), request: AutomateRequest = None):
-    input_text = request.text.lower() if request else ""
+    input_text = request.text if request else ""
     response = {"response": "", "taskExecuted": False, "taskType": None}
     
-    # Keywords first (integrated JS keyword logic)
-    lower_text = input_text.lower()
-    if "alarm" in lower_text or "reminder" in lower_text:
+    # Keywords first
+    task = route_task(input_text)
+    if task == "alarm":
         response["response"] = "Alarm scheduled locally."  # JS local
         response["taskExecuted"] = True
         response["taskType"] = "alarm"
-    elif "iot" in lower_text or "light" in lower_text:
+    elif task == "iot":
         response["response"] = "IoT command processed internally."
         response["taskExecuted"] = True
         response["taskType"] = "iot"
         # Emit to clients (JS io.emit)
-        await sio.emit('iot_command', { 'cmd': input_text })
+        await broadcast_batched('iot_command', { 'cmd': input_text })
         # Forward via RustDesk if active
         active_session = await get_active_rustdesk(did)
         if active_session:
             await forward_iot_command(active_session['rustdesk_id'], input_text)
-    elif "script" in lower_text or "bash" in lower_text:
+    elif task == "script":
         response["response"] = "Bash script generated and queued for execution."
         response["taskExecuted"] = True
         response["taskType"] = "script"
@@ -524,10 +893,7 @@ async def automate_task(did: str = Depends(verify_token), request: AutomateReque
         nlp = await get_nlp_pipeline()
         if nlp:
             try:
-                loop = asyncio.get_event_loop()
-                ai_output = await loop.run_in_executor(
-                    None, lambda: nlp(input_text, max_length=100, num_return_sequences=1)[0]['generated_text']
-                )
+                ai_output = await generate_text(input_text)
                 response["response"] = ai_output.strip()
             except Exception as e:
                 logger.error(f"AI error: {e}")
@@ -572,8 +938,8 @@ async def activate_iot_scene(did: str = Depends(verify_token), input: IotActivat
 @api_router.get("/emulators", response_model=List[Emulator])
 async def get_emulators(did: str = Depends(verify_token)):
     # Filter for device compatible
-    emulators_cursor = await db.emulators.find({"ramRequired": {"$lte": MOCK_DEVICE_RAM}}).to_list(1000)
-    return [Emulator(**em) for em in emulators_cursor]
+    cursor = db.emulators.find({"ramRequired": {"$lte": MOCK_DEVICE_RAM}}, projection(Emulator)).batch_size(LIST_BATCH_SIZE)
+    return await stream_json_array(cursor)
 
 @api_router.post("/emulators/{platform}/{version}/download", response_model=Emulator)
 async def download_emulator(did: str = Depends(verify_token), platform: str = None, version: str = None):
@@ -631,21 +997,27 @@ async def simulate_download(platform: str, version: str, emulator_id: str):
         )
         logger.error(f"Download simulation failed: {e}")
 
+emulator_processes: dict[str, psutil.Process] = {}  # {emulator_id: primed psutil handle of the running emulator}
+
 @api_router.post("/emulators/{emulator_id}/run")
 async def run_emulator(did: str = Depends(verify_token), emulator_id: str = None):
-    emulator = await db.emulators.find_one({"id": emulator_id})
+    emulator, running_ram = await find_with_running_ram(db.emulators, emulator_id, EmulatorStatus.RUNNING.value)
     if not emulator or emulator["platform"] != "android":
         raise HTTPException(status_code=400, detail="Android only supported")
     
     current_status = emulator.get("status", EmulatorStatus.AVAILABLE)
     new_status = EmulatorStatus.STOPPED if current_status == EmulatorStatus.RUNNING else EmulatorStatus.RUNNING
     
+    if new_status == EmulatorStatus.RUNNING and running_ram + emulator["ramRequired"] > MOCK_DEVICE_RAM:
+        raise HTTPException(status_code=400, detail="Insufficient RAM")
+    
+    # Claim the transition before launching so a concurrent toggle can't start a second instance
+    status_filter = {"id": emulator_id, "status": emulator.get("status")}
+    updated = await db.emulators.find_one_and_update(status_filter, {"$set": {"status": new_status.value}})
+    if updated is None:
+        raise HTTPException(status_code=409, detail="Emulator changed concurrently; retry")
+    
     if new_status == EmulatorStatus.RUNNING:
-        running_emus = await db.emulators.find({"status": EmulatorStatus.RUNNING}).to_list(1000)
-        running_ram = sum(e["ramRequired"] for e in running_emus)
-        if running_ram + emulator["ramRequired"] > MOCK_DEVICE_RAM:
-            raise HTTPException(status_code=400, detail="Insufficient RAM")
-        
         try:
             avd_name = f"{emulator['version'].lower().replace(' ', '_')}"
             proc = await asyncio.create_subprocess_exec(
@@ -654,26 +1026,49 @@ async def run_emulator(did: str = Depends(verify_token), emulator_id: str = None
             )
             # Port forward for RustDesk
             await asyncio.create_subprocess_exec("adb", "-s", avd_name, "forward", "tcp:21115", "tcp:21115")
-            asyncio.create_task(monitor_emulator(proc.pid, emulator_id))
+            p = primed_process(proc.pid)
+            if p is None:
+                # Died right after spawn: release the claimed status (and its RAM) instead of leaving it running
+                await mark_emulator_stopped(emulator_id)
+                raise HTTPException(status_code=500, detail="Emulator exited during launch")
+            emulator_processes[emulator_id] = p
+            monitors[f"emulator:{emulator_id}"] = lambda: sample_emulator(p, emulator_id)
             logger.info(f"Emulator {avd_name} launched for {did}")
         except FileNotFoundError:
+            await db.emulators.update_one({"id": emulator_id}, {"$set": {"status": current_status}})
             raise HTTPException(status_code=500, detail="Android SDK/emulator not in PATH")
+    else:
+        p = emulator_processes.get(emulator_id)
+        if p is not None:
+            try:
+                p.terminate()  # SIGTERM; psutil guards against a recycled pid
+            except psutil.NoSuchProcess:
+                pass  # Already exited
+        await mark_emulator_stopped(emulator_id)
     
-    await db.emulators.update_one({"id": emulator_id}, {"$set": {"status": new_status.value}})
     return {"message": f"Emulator toggled to {new_status}", "detail": "Success"}
 
-async def monitor_emulator(pid: int, emulator_id: str):
-    while True:
-        try:
-            p = psutil.Process(pid)
-            if p.cpu_percent(interval=1) > 70:
-                await db.emulators.update_one({"id": emulator_id}, {"$set": {"status": EmulatorStatus.STOPPED}})
-                os.kill(pid, signal.SIGTERM)
-                logger.warning(f"Emulator {emulator_id} stopped: High CPU")
-                break
-        except psutil.NoSuchProcess:
-            break
-        await asyncio.sleep(30)
+async def mark_emulator_stopped(emulator_id: str):
+    # Every monitor exit releases the emulator's RAM in the budget (see find_with_running_ram)
+    monitors.pop(f"emulator:{emulator_id}", None)
+    emulator_processes.pop(emulator_id, None)
+    await db.emulators.update_one(
+        {"id": emulator_id, "status": EmulatorStatus.RUNNING.value}, {"$set": {"status": EmulatorStatus.STOPPED.value}}
+    )
+
+async def sample_emulator(p: psutil.Process, emulator_id: str):
+    try:
+        # Non-blocking delta since the previous tick; the handle was primed at launch
+        if await run_sampler(p.cpu_percent, None) > 70:
+            try:
+                p.terminate()  # SIGTERM; psutil guards against a recycled pid
+            except psutil.NoSuchProcess:
+                pass  # Exited between the sample and the kill
+            await mark_emulator_stopped(emulator_id)
+            logger.warning(f"Emulator {emulator_id} stopped: High CPU")
+    except psutil.NoSuchProcess:
+        await mark_emulator_stopped(emulator_id)
+        logger.warning(f"Emulator {emulator_id} exited")
 
 @api_router.post("/emulators", response_model=Emulator)
 async def create_emulator(did: str = Depends(verify_token), input: EmulatorCreate = None):
@@ -689,7 +1084,7 @@ async def create_emulator(did: str = Depends(verify_token), input: EmulatorCreat
 async def generate_rustdesk_session(did: str = Depends(verify_token), input: RustDeskGenerate = None):
     device_id = input.device_id if input else did
     # From JS Math.random.toString(36)
-    rustdesk_id = ''.join([str(uuid.uuid4().int >> 4 & 0xFFFF)[0:2] for _ in range(4)]).upper()
+    rustdesk_id = new_rustdesk_id()
     password = "123456"  # Baked from JS
     
     # Start server if needed (from JS)
@@ -704,7 +1099,7 @@ async def generate_rustdesk_session(did: str = Depends(verify_token), input: Rus
 async def rustdesk_status(did: str = Depends(verify_token), device_id: str = None):
     status = {"running": device_id in rustdesk_processes, "sessions": []}
     sessions = await db.rustdesk_sessions.find({"device_id": device_id}).to_list(1000)
-    status["sessions"] = [RustDeskSession(**s) for s in sessions]
+    status["sessions"] = [RustDeskSession.model_construct(**s) for s in sessions]  # Written from RustDeskSession
     return status
 
 @api_router.post("/rustdesk/connect/{rustdesk_id}")
@@ -727,22 +1122,21 @@ async def get_active_rustdesk(did: str):
 
 # Local DB Mock Integration (from JS AsyncStorage - optional fallback)
 async def local_db_fallback(collection: str, operation: str, data: dict = None):
-    # Simulate AsyncStorage with file-based JSON
-    db_file = ROOT_DIR / f"local_{collection}.json"
+    # Simulate AsyncStorage with an append-only NDJSON file (one document per line)
+    db_file = ROOT_DIR / f"local_{collection}.ndjson"
     if operation == "insertOne":
-        docs = []
-        if db_file.exists():
-            with open(db_file, 'r') as f:
-                docs = json.load(f)
-        docs.append({**data, "timestamp": datetime.utcnow().isoformat()})
-        with open(db_file, 'w') as f:
-            json.dump(docs, f)
+        async with aiofiles.open(db_file, 'ab') as f:
+            await f.write(orjson.dumps({**data, "timestamp": datetime.utcnow().isoformat()}) + b'\n')
         return {"success": True}
     elif operation == "find":
-        if db_file.exists():
-            with open(db_file, 'r') as f:
-                return json.load(f)
-        return []
+        if not db_file.exists():
+            return []
+        docs = []
+        async with aiofiles.open(db_file, 'rb') as f:
+            async for line in f:
+                if line.strip():
+                    docs.append(orjson.loads(line))
+        return docs
     return None
 
 app.include_router(api_router)
@@ -752,4 +1146,5 @@ async def shutdown():
     client.close()
     for session_id in list(rustdesk_processes.keys()):
         await stop_rustdesk_server(session_id)
+    monitor_executor.shutdown(wait=False)
     logger.info("Shutdown complete")
\ No newline at end of file